@@ -1,13 +1,31 @@
 # app.py
 import os
-import json
+import time
+import re
+import html
+import asyncio
+import hashlib
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from io import BytesIO
 
+import orjson
 from dotenv import load_dotenv
 import streamlit as st
 from PIL import Image, UnidentifiedImageError
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+# Advisory file locking (POSIX only) - meta updates go unlocked elsewhere
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Optional TTS engine (offline) - used only if available
 try:
@@ -16,53 +34,72 @@ try:
 except Exception:
     TTS_AVAILABLE = False
 
+# Optional semantic cache (near-duplicate questions) - used only if available
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    SEMANTIC_CACHE_AVAILABLE = True
+except Exception:
+    SEMANTIC_CACHE_AVAILABLE = False
+
 # -----------------------
 # Config & Bootstrap
 # -----------------------
 load_dotenv()
 API_KEY = os.getenv("GOOGLE_API_KEY", "")
+MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", "2"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "4"))
+INFLIGHT_POLL_SECONDS = 0.5
+ANSWER_CACHE_MAX_ENTRIES = 256
 st.set_page_config(page_title="IMAGE SUMMARY", page_icon="✨", layout="wide")
 
 # CSS + small animations (glass, glow, button bounce, chat bubbles)
-st.markdown(
-    """
-    <style>
-    /* page bg & fonts */
-    .stApp { background: linear-gradient(180deg, #0f1724 0%, #071022 100%); color: #E6EEF8; }
-
-    /* glowing upload card */
-    .upload-card {
-        border-radius: 14px;
-        padding: 18px;
-        border: 1px solid rgba(255,255,255,0.06);
-        background: linear-gradient(180deg, rgba(255,255,255,0.02), rgba(255,255,255,0.01));
-        box-shadow: 0 6px 18px rgba(2,6,23,0.6);
-        text-align: center;
-        transition: transform .28s ease, box-shadow .28s ease;
-    }
-    .upload-card:hover { transform: translateY(-6px); box-shadow: 0 18px 40px rgba(0,186,255,0.06); }
-    .glow { animation: pulse 2.8s ease-in-out infinite; }
-    @keyframes pulse {
-      0% { box-shadow: 0 0 8px rgba(0,186,255,0.06); }
-      50% { box-shadow: 0 0 24px rgba(0,186,255,0.12); }
-      100% { box-shadow: 0 0 8px rgba(0,186,255,0.06); }
-    }
-
-    /* chat bubble */
-    .bubble-user { background: linear-gradient(90deg,#0ea5e9,#7dd3fc); color: #021024; padding:10px 14px; border-radius:12px; width:fit-content; max-width:70%; }
-    .bubble-assistant { background: rgba(255,255,255,0.03); color: #E6EEF8; padding:10px 14px; border-radius:12px; width:fit-content; max-width:80%; }
-
-    /* send button */
-    .send-btn { border-radius: 10px; padding: 10px 20px; background: linear-gradient(90deg,#ff6b6b,#ff9a9e); color:white; border:none; cursor:pointer; transition: transform .12s ease; }
-    .send-btn:active { transform: translateY(2px) scale(.995); }
-
-    /* small utilities */
-    .muted { color: #9AA8BF; font-size: 13px; }
-    .control-card { border-radius:10px; padding:12px; background: rgba(255,255,255,0.01); }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+_CSS = """
+<style>
+/* page bg & fonts */
+.stApp { background: linear-gradient(180deg, #0f1724 0%, #071022 100%); color: #E6EEF8; }
+
+/* glowing upload card */
+.upload-card {
+    border-radius: 14px;
+    padding: 18px;
+    border: 1px solid rgba(255,255,255,0.06);
+    background: linear-gradient(180deg, rgba(255,255,255,0.02), rgba(255,255,255,0.01));
+    box-shadow: 0 6px 18px rgba(2,6,23,0.6);
+    text-align: center;
+    transition: transform .28s ease, box-shadow .28s ease;
+}
+.upload-card:hover { transform: translateY(-6px); box-shadow: 0 18px 40px rgba(0,186,255,0.06); }
+.glow { animation: pulse 2.8s ease-in-out infinite; }
+@keyframes pulse {
+  0% { box-shadow: 0 0 8px rgba(0,186,255,0.06); }
+  50% { box-shadow: 0 0 24px rgba(0,186,255,0.12); }
+  100% { box-shadow: 0 0 8px rgba(0,186,255,0.06); }
+}
+
+/* chat bubble */
+.bubble-user { background: linear-gradient(90deg,#0ea5e9,#7dd3fc); color: #021024; padding:10px 14px; border-radius:12px; width:fit-content; max-width:70%; }
+.bubble-assistant { background: rgba(255,255,255,0.03); color: #E6EEF8; padding:10px 14px; border-radius:12px; width:fit-content; max-width:80%; }
+
+/* send button */
+.send-btn { border-radius: 10px; padding: 10px 20px; background: linear-gradient(90deg,#ff6b6b,#ff9a9e); color:white; border:none; cursor:pointer; transition: transform .12s ease; }
+.send-btn:active { transform: translateY(2px) scale(.995); }
+
+/* small utilities */
+.muted { color: #9AA8BF; font-size: 13px; }
+.control-card { border-radius:10px; padding:12px; background: rgba(255,255,255,0.01); }
+</style>
+"""
+
+@st.cache_data
+def _css_once():
+    # Minified once per process (the script body re-runs, so lru_cache wouldn't
+    # survive). Streamlit clears the page each rerun, so it is still emitted.
+    css = re.sub(r"/\*.*?\*/", "", _CSS, flags=re.S)
+    return re.sub(r"\s+", " ", css).strip()
+
+st.markdown(_css_once(), unsafe_allow_html=True)
 
 # -----------------------
 # Helper utilities
@@ -70,58 +107,385 @@ st.markdown(
 def now_iso():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-HISTORY_FILE = "history.json"
+# History is an append-only JSONL transcript (one entry per line; a later line
+# with the same id replaces an earlier one) plus a tiny meta file.
+HISTORY_FILE = "history.jsonl"
+HISTORY_META_FILE = "history.meta.json"
+LEGACY_HISTORY_FILE = "history.json"
+META_LOCK_TIMEOUT = 10  # seconds
+AUTO_SAVE_INTERVAL = int(os.getenv("AUTO_SAVE_INTERVAL", "5"))  # turns between flushes
+
+@contextmanager
+def _meta_lock():
+    if fcntl is None:
+        yield
+        return
+    with open(HISTORY_META_FILE + ".lock", "w") as lock_file:
+        deadline = time.monotonic() + META_LOCK_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for lock on {HISTORY_META_FILE}")
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _append_entry(entry):
+    with open(HISTORY_FILE, "ab") as f:
+        f.write(orjson.dumps(entry) + b"\n")
+
+def _update_meta(appended=0, reset=False):
+    with _meta_lock():
+        lines = 0
+        if not reset and os.path.exists(HISTORY_META_FILE):
+            try:
+                with open(HISTORY_META_FILE, "rb") as f:
+                    lines = orjson.loads(f.read()).get("lines", 0)
+            except Exception:
+                pass
+        meta = {"saved_at": now_iso(), "lines": lines + appended}
+        # write-then-rename so readers never see a half-written meta file
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(os.path.abspath(HISTORY_META_FILE)), delete=False, suffix=".tmp") as f:
+            f.write(orjson.dumps(meta, option=orjson.OPT_INDENT_2))
+        os.replace(f.name, HISTORY_META_FILE)
+
+def _flush_entries(pending):
+    # touches no session state, so it is also safe to run from a finalizer
+    if not pending:
+        return
+    entries = list(pending)
+    for entry in entries:
+        _append_entry(entry)
+    _update_meta(appended=len(entries))
+    del pending[:len(entries)]
+
+class _SessionOwner:
+    """Lives only in one session's state; its collection marks the session's end."""
+
+def _flush_on_session_end(pending):
+    try:
+        _flush_entries(pending)
+    except Exception:
+        pass
+
+def _arm_session_flush():
+    # Streamlit has no session-end hook: flush the buffer when the session's
+    # state is collected (or at interpreter exit, which finalize also covers).
+    # The callback holds only the buffer, never the owner, so it can fire.
+    finalizer = st.session_state.get("_flush_finalizer")
+    if finalizer is None or not finalizer.alive:
+        st.session_state._flush_finalizer = weakref.finalize(
+            st.session_state._session_owner, _flush_on_session_end, st.session_state._pending_entries
+        )
+
+def drop_pending_entries():
+    # persistence switched off: unsaved entries must never reach the disk
+    finalizer = st.session_state.get("_flush_finalizer")
+    if finalizer is not None:
+        finalizer.detach()
+    st.session_state._pending_entries.clear()
+    st.session_state._turns_since_save = 0
 
 def save_history_to_disk():
+    """Flush this session's buffered entries to the transcript now."""
+    st.session_state._turns_since_save = 0
+    try:
+        _flush_entries(st.session_state._pending_entries)
+    except Exception as e:
+        st.warning(f"Could not save history to disk: {e}")
+
+def _maybe_save(*entries):
+    """Buffer new or changed entries; only hit the disk every AUTO_SAVE_INTERVAL turns."""
+    st.session_state._history_rev += 1  # called after every edit; invalidates export blobs
+    if not st.session_state.get("persist_opt_in", False):
+        return
+    st.session_state._pending_entries.extend(entries)
+    _arm_session_flush()
+    st.session_state._turns_since_save += 1
+    if st.session_state._turns_since_save >= AUTO_SAVE_INTERVAL:
+        save_history_to_disk()
+
+def clear_history_on_disk():
+    st.session_state._pending_entries.clear()
+    st.session_state._turns_since_save = 0
     if not st.session_state.get("persist_opt_in", False):
         return
     try:
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump({"saved_at": now_iso(), "items": st.session_state.history}, f, ensure_ascii=False, indent=2)
+        open(HISTORY_FILE, "w", encoding="utf-8").close()
+        _update_meta(reset=True)
     except Exception as e:
         st.warning(f"Could not save history to disk: {e}")
 
 def load_history_from_disk():
     if not os.path.exists(HISTORY_FILE):
+        _load_legacy_history()
+        return
+    try:
+        items = {}
+        with open(HISTORY_FILE, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # torn write from a crash; skip the line
+                items[entry.get("id")] = entry
+        st.session_state.history = list(items.values())
+    except Exception:
+        pass
+
+def _load_legacy_history():
+    # one-time migration from the old single-document history.json
+    if not os.path.exists(LEGACY_HISTORY_FILE):
         return
     try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(LEGACY_HISTORY_FILE, "rb") as f:
+            data = orjson.loads(f.read())
             items = data.get("items", [])
             if isinstance(items, list):
                 st.session_state.history = items
+                _flush_entries(list(items))
     except Exception:
         pass
 
-def export_history_bytes():
-    payload = {"exported_at": now_iso(), "items": st.session_state.history}
-    b = BytesIO()
-    b.write(json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8"))
-    b.seek(0)
-    return b
+def history_signature():
+    # cheap stand-in for the history contents: length, newest id and edit count
+    hist = st.session_state.history
+    return (len(hist), hist[-1]["id"] if hist else "", st.session_state._history_rev)
 
-def download_text_bytes(text: str, filename="ai_response.txt"):
-    buf = BytesIO()
-    buf.write(text.encode("utf-8"))
-    buf.seek(0)
-    return buf
+def _memoized(name: str, sig, build):
+    # per-session memo so idle reruns don't re-serialize unchanged history
+    cache = st.session_state._blob_cache
+    if name not in cache or cache[name][0] != sig:
+        cache[name] = (sig, build())
+    return cache[name][1]
 
-# Gemini model init (lazy)
-if API_KEY:
+def export_history_bytes():
+    def build():
+        payload = {"exported_at": now_iso(), "items": st.session_state.history}
+        return orjson.dumps(payload, option=orjson.OPT_INDENT_2)
+    return _memoized("export", history_signature(), build)
+
+# pyttsx3 shares one engine per driver, so playback is serialized process-wide
+@st.cache_resource
+def get_tts_lock():
+    return threading.Lock()
+
+def _speak(text: str, lock: threading.Lock, status: dict):
+    # runs on a daemon thread: runAndWait() blocks for the whole playback.
+    # Errors go into the session's status dict for the next rerun to show.
+    try:
+        eng = pyttsx3.init()
+        eng.say(text)
+        eng.runAndWait()
+        eng.stop()
+    except Exception as e:
+        status["error"] = str(e)
+    finally:
+        lock.release()
+
+# Gemini model init (lazy, built once per process and reused across reruns)
+@st.cache_resource
+def get_model():
+    if not API_KEY:
+        return None
     try:
         genai.configure(api_key=API_KEY)
-        model = genai.GenerativeModel("models/gemini-1.5-flash-latest")
+        return genai.GenerativeModel("models/gemini-1.5-flash-latest")
     except Exception:
-        model = None
-else:
-    model = None
+        return None
+
+MAX_IMAGE_SIDE = 1568  # Gemini's native tile size; larger only costs tokens
+PREVIEW_SIDE = 400
+
+def downscale_image(img: Image.Image) -> bytes:
+    """Shrink in place to fit MAX_IMAGE_SIDE and return it as JPEG bytes (q=85)."""
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def image_fingerprint(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+NO_TEXT_ANSWER = "(No text returned)"
 
-def generate_answer(question: str, image_obj: Image.Image):
+class EmptyAnswerError(RuntimeError):
+    """Gemini returned no text; raised so st.cache_data doesn't memoize it."""
+
+# Answers are memoized per (question, image hash); the leading underscore keeps
+# the raw bytes out of Streamlit's cache key so only the fingerprint is hashed.
+@st.cache_data(show_spinner=False, max_entries=ANSWER_CACHE_MAX_ENTRIES)
+def generate_answer(question: str, img_hash: str, _img_bytes: bytes) -> str:
+    model = get_model()
     if not model:
         raise RuntimeError("Generative model not configured (missing/invalid GOOGLE_API_KEY).")
     # Gemini accepts PIL image in SDK as per earlier usage
-    resp = model.generate_content([question, image_obj])
-    return resp.text or "(No text returned)"
+    image_obj = Image.open(BytesIO(_img_bytes)).convert("RGB")
+    coro = _generate_async(model, get_llm_semaphore(), question, image_obj)
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    answer = future.result()
+    if not answer:
+        raise EmptyAnswerError(NO_TEXT_ANSWER)
+    return answer
+
+@st.cache_resource
+def get_embedder():
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+def embed_question(question: str):
+    if not SEMANTIC_CACHE_AVAILABLE:
+        return None
+    try:
+        return get_embedder().encode(question, normalize_embeddings=True)
+    except Exception:
+        return None  # e.g. model download failed; fall back to exact-match caching
+
+def semantic_lookup(vec, img_hash: str):
+    """Answer from an earlier, similarly worded question about the same image, if any."""
+    cached = st.session_state._emb_cache.get(img_hash)
+    if vec is None or not cached:
+        return None
+    scores = np.stack([v for v, _ in cached]) @ vec  # cosine: vectors are normalized
+    best = int(scores.argmax())
+    return cached[best][1] if scores[best] >= SEMANTIC_CACHE_THRESHOLD else None
+
+def semantic_store(vec, img_hash: str, answer: str):
+    if vec is not None:
+        st.session_state._emb_cache.setdefault(img_hash, []).append((vec, answer))
+
+# Worker pool for blocking Gemini calls, so the script thread returns immediately
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=LLM_WORKERS)
+
+# Single background event loop per process, so the SDK's async client (and
+# anything else bound to a loop) survives across reruns and sessions.
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Process-wide cap on in-flight Gemini requests (free tier allows very few).
+@st.cache_resource
+def get_llm_semaphore():
+    return asyncio.Semaphore(MAX_CONCURRENT)
+
+async def _generate_async(model, sem: asyncio.Semaphore, question: str, image_obj: Image.Image) -> str:
+    # Retry outside the semaphore so backoff sleeps don't hold a slot
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type(ResourceExhausted),
+        stop=stop_after_attempt(5),
+        wait=wait_random_exponential(min=1, max=30),
+        reraise=True,
+    ):
+        with attempt:
+            async with sem:
+                resp = await model.generate_content_async([question, image_obj])
+    return resp.text
+
+async def _gather(model, sem, questions, image_obj):
+    return await asyncio.gather(
+        *[_generate_async(model, sem, q, image_obj) for q in questions],
+        return_exceptions=True,
+    )
+
+def generate_answers_parallel(questions, img_bytes: bytes):
+    """Fire all questions at the same image concurrently; one answer per question."""
+    model = get_model()
+    if not model:
+        raise RuntimeError("Generative model not configured (missing/invalid GOOGLE_API_KEY).")
+    image_obj = Image.open(BytesIO(img_bytes)).convert("RGB")
+    future = asyncio.run_coroutine_threadsafe(_gather(model, get_llm_semaphore(), questions, image_obj), get_event_loop())
+    return [f"Error: {r}" if isinstance(r, Exception) else (r or NO_TEXT_ANSWER) for r in future.result()]
+
+def sidebar_entry_html(n: int, entry) -> str:
+    ts = html.escape(entry.get("timestamp",""))
+    q = html.escape(entry.get("question",""))
+    a = entry.get("answer","")
+    a = html.escape(a if len(a) < 240 else a[:240]+"…")
+    # a blank line would end the HTML block and let Markdown take over the rest
+    q = q.replace("\n", " ")
+    a = a.replace("\n", "<br>")
+    pin = "📌" if entry.get("pinned", False) else ""
+    star = "⭐" if entry.get("rating", 0) >= 4 else ""
+    return (
+        f"<div style='margin-bottom:12px'><strong>{n}. {star} {q}</strong><br>"
+        f"<em class='muted'>{ts}</em> {pin}<br>{a}</div>"
+    )
+
+def record_answers(questions, answers):
+    """Append one history entry per answered question; returns the new entries."""
+    batch_ts = datetime.now().timestamp()
+    entries = []
+    for n, (question, answer) in enumerate(zip(questions, answers)):
+        entry = {
+            # suffix keeps ids (and pin keys) unique within a batch
+            "id": f"{batch_ts}" if len(questions) == 1 else f"{batch_ts}-{n}",
+            "timestamp": now_iso(),
+            "question": question,
+            "answer": answer,
+            "rating": 0,
+            "pinned": False
+        }
+        st.session_state.history.append(entry)
+        st.session_state.achievements["questions_today"] += 1
+        entries.append(entry)
+    _maybe_save(*entries)
+    return entries
+
+def _generate_one(question: str, img_hash: str, img_bytes: bytes):
+    return [generate_answer(question, img_hash, img_bytes)]
+
+def submit_job(questions, fn, *args, img_hash=None, vec=None):
+    # fn(*args) runs on a worker thread: arguments are bound now, and it must
+    # not touch st.session_state
+    st.session_state._inflight.append({
+        "future": get_executor().submit(fn, *args),
+        "questions": questions,
+        "img_hash": img_hash,
+        "vec": vec,
+    })
+
+@st.fragment(run_every=INFLIGHT_POLL_SECONDS)
+def poll_inflight():
+    pending = st.session_state._inflight
+    done = [job for job in pending if job["future"].done()]
+    if not done:
+        n = sum(len(job["questions"]) for job in pending)
+        st.info(f"🤖 Generating {n} response{'s' if n > 1 else ''}...")
+        if st.button("✖️ Cancel", key="cancel_inflight"):
+            for job in pending:
+                job["future"].cancel()  # no-op once running; the result is dropped
+            pending.clear()
+            st.rerun()
+        return
+    for job in done:
+        pending.remove(job)
+        try:
+            answers = job["future"].result()
+            if job["vec"] is not None:
+                semantic_store(job["vec"], job["img_hash"], answers[0])
+        except EmptyAnswerError:
+            answers = [NO_TEXT_ANSWER] * len(job["questions"])
+        except Exception as e:
+            answers = [f"Error: {e}"] * len(job["questions"])
+        record_answers(job["questions"], answers)
+    st.rerun()
+
+def render_chat():
+    # show conversation (last 10)
+    for item in st.session_state.history[-10:]:
+        st.markdown(f"<div class='bubble-user'>{item['question']}</div>", unsafe_allow_html=True)
+        st.markdown(f"<div class='bubble-assistant'>{item['answer']}</div>", unsafe_allow_html=True)
 
 # -----------------------
 # Session state & default
@@ -129,15 +493,35 @@ def generate_answer(question: str, image_obj: Image.Image):
 if "history" not in st.session_state:
     st.session_state.history = []   # list of dicts {id, timestamp, question, answer, rating, pinned}
 if "current_image" not in st.session_state:
-    st.session_state.current_image = None
+    st.session_state.current_image = None   # small preview thumbnail only
+if "current_image_bytes" not in st.session_state:
+    st.session_state.current_image_bytes = None
+if "current_image_hash" not in st.session_state:
+    st.session_state.current_image_hash = None
 if "persist_opt_in" not in st.session_state:
     st.session_state.persist_opt_in = False
 if "achievements" not in st.session_state:
     st.session_state.achievements = {"questions_today": 0, "first_upload_done": False}
-
-# If user opted in previously, load
-if st.session_state.persist_opt_in:
+if "_pending_entries" not in st.session_state:
+    st.session_state._pending_entries = []   # entries not yet flushed to disk
+    st.session_state._session_owner = _SessionOwner()
+if "_history_rev" not in st.session_state:
+    st.session_state._history_rev = 0
+if "_blob_cache" not in st.session_state:
+    st.session_state._blob_cache = {}
+if "_inflight" not in st.session_state:
+    st.session_state._inflight = []   # pending jobs: {future, questions, img_hash, vec}
+if "_emb_cache" not in st.session_state:
+    st.session_state._emb_cache = {}   # image hash -> [(question embedding, answer)]
+if "_tts_status" not in st.session_state:
+    st.session_state._tts_status = {}   # written by the TTS thread, read on rerun
+if "_turns_since_save" not in st.session_state:
+    st.session_state._turns_since_save = 0
+
+# If user opted in previously, load (once - reloading would drop unflushed turns)
+if st.session_state.persist_opt_in and not st.session_state.get("_history_loaded", False):
     load_history_from_disk()
+    st.session_state._history_loaded = True
 
 # -----------------------
 # Layout: Sidebar Controls
@@ -145,29 +529,26 @@ if st.session_state.persist_opt_in:
 with st.sidebar:
     st.header("⚙️ App Controls")
     st.caption("Privacy-first: images kept in memory only; text is optional persisted.")
-    st.session_state.persist_opt_in = st.checkbox("📥 Persist history to disk (text-only)", value=st.session_state.persist_opt_in, help="When enabled, conversation text will be stored in history.json in this folder.")
+    st.session_state.persist_opt_in = st.checkbox("📥 Persist history to disk (text-only)", value=st.session_state.persist_opt_in, help="When enabled, conversation text will be stored in history.jsonl in this folder.")
+    if not st.session_state.persist_opt_in and st.session_state._pending_entries:
+        drop_pending_entries()
     if st.button("🗑️ Clear Session History"):
         st.session_state.history = []
-        save_history_to_disk()
+        clear_history_on_disk()
         st.success("Session history cleared.")
     st.download_button("⬇️ Export History (JSON)", data=export_history_bytes(), file_name="vision_history.json", mime="application/json")
     st.markdown("---")
     st.subheader("📝 Conversation History")
     if st.session_state.history:
-        # show most recent 6 with quick actions
-        for entry in reversed(st.session_state.history[-6:]):
-            ts = entry.get("timestamp","")
-            q = entry.get("question","")
-            a = entry.get("answer","")
-            pinned = entry.get("pinned", False)
-            star = "⭐" if entry.get("rating", 0) >= 4 else ""
-            st.markdown(f"**{star} {q}**  \n_{ts}_  {'📌' if pinned else ''}")
-            st.write(a if len(a) < 240 else a[:240]+"…")
-            cols = st.columns([0.18,0.82])
-            if cols[0].button("📌", key=f"pin_{ts}"):
-                entry["pinned"] = not pinned
-                save_history_to_disk()
-                st.experimental_rerun()
+        # show most recent 6 as one markdown block, then a row of pin toggles
+        recent = list(reversed(st.session_state.history[-6:]))
+        st.markdown("".join(sidebar_entry_html(i, entry) for i, entry in enumerate(recent, 1)), unsafe_allow_html=True)
+        cols = st.columns(len(recent))
+        for i, (col, entry) in enumerate(zip(cols, recent), 1):
+            if col.button(f"📌{i}", key=f"pin_{entry['id']}"):
+                entry["pinned"] = not entry.get("pinned", False)
+                _maybe_save(entry)
+                st.rerun()
     else:
         st.info("No history yet — upload an image and ask a question to begin.")
 
@@ -193,14 +574,28 @@ with col1:
     uploaded = st.file_uploader("", type=["jpg","jpeg","png"], accept_multiple_files=False, key="uploader")
     if uploaded:
         try:
-            img = Image.open(uploaded).convert("RGB")
-            st.session_state.current_image = img
-            st.image(img, caption="Preview", use_column_width=True)
+            raw = uploaded.getvalue()
+            new_hash = image_fingerprint(raw)
+            # only decode when the upload actually changed, not on every rerun
+            if new_hash != st.session_state.current_image_hash:
+                img = Image.open(BytesIO(raw))
+                # JPEG: let the decoder scale down during decode instead of
+                # materializing the full-resolution RGB array first
+                img.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+                img = img.convert("RGB")
+                st.session_state.current_image_bytes = downscale_image(img)
+                # keep only a small preview resident; Gemini calls decode the bytes on demand
+                img.thumbnail((PREVIEW_SIDE, PREVIEW_SIDE))
+                st.session_state.current_image = img
+                st.session_state.current_image_hash = new_hash
+            st.image(st.session_state.current_image, caption="Preview", use_column_width=True)
             if not st.session_state.achievements["first_upload_done"]:
                 st.session_state.achievements["first_upload_done"] = True
         except UnidentifiedImageError:
             st.error("Could not decode image. Upload a valid JPG/PNG.")
             st.session_state.current_image = None
+            st.session_state.current_image_bytes = None
+            st.session_state.current_image_hash = None
     else:
         st.info("Upload an image to interact with the AI.")
 
@@ -220,19 +615,18 @@ with col1:
 # ---------- Right Column: Chat / Q&A ----------
 with col2:
     st.subheader("💬 Ask the AI about this image")
-    # show conversation (last 10)
     if st.session_state.history:
-        for item in st.session_state.history[-10:]:
-            st.markdown(f"<div class='bubble-user'>{item['question']}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='bubble-assistant'>{item['answer']}</div>", unsafe_allow_html=True)
+        render_chat()
 
     prompt = st.text_input("Your question", value=preset_text, key="prompt_input", placeholder="Try: 'Summarize this image'")
 
     # small row for buttons and toggles
     cols = st.columns([0.18,0.18,0.18,0.46])
     send_clicked = cols[0].button("🚀 Send", key="send_btn")
+    run_all_clicked = st.button("⚡ Run all presets", key="run_all_btn")
     play_tts = cols[1].button("🔊 Play last (TTS)" if TTS_AVAILABLE else "🔇 TTS N/A", key="tts_btn")
-    cols[2].download_button("💾 Download last", data=download_text_bytes(st.session_state.history[-1]["answer"]) if st.session_state.history else "", file_name="latest_answer.txt")
+    if st.session_state.history:
+        cols[2].download_button("💾 Download last", data=st.session_state.history[-1]["answer"], file_name="latest_answer.txt")
     cols[3].checkbox("I understand text-only persistence", value=True, key="ack_persist")
 
     # quick-mode buttons
@@ -261,26 +655,31 @@ with col2:
         elif not prompt.strip():
             st.error("Please enter a question.")
         else:
-            with st.spinner("🤖 Generating response..."):
-                try:
-                    answer = generate_answer(prompt.strip(), st.session_state.current_image)
-                except Exception as e:
-                    answer = f"Error: {e}"
-            # record
-            entry = {
-                "id": f"{datetime.now().timestamp()}",
-                "timestamp": now_iso(),
-                "question": prompt.strip(),
-                "answer": answer,
-                "rating": 0,
-                "pinned": False
-            }
-            st.session_state.history.append(entry)
-            st.session_state.achievements["questions_today"] += 1
-            save_history_to_disk()
-            # render new chat bubble
-            st.markdown(f"<div class='bubble-user'>{entry['question']}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='bubble-assistant'>{entry['answer']}</div>", unsafe_allow_html=True)
+            question = prompt.strip()
+            img_hash = st.session_state.current_image_hash
+            img_bytes = st.session_state.current_image_bytes
+            vec = embed_question(question)
+            answer = semantic_lookup(vec, img_hash)
+            if answer is not None:
+                record_answers([question], [answer])
+                st.rerun()  # render_chat shows it, like answers from the worker pool
+            else:
+                submit_job([question], _generate_one, question, img_hash, img_bytes, img_hash=img_hash, vec=vec)
+
+    # Run-all logic: every preset against the current image, concurrently
+    if run_all_clicked:
+        if not API_KEY:
+            st.error("GOOGLE_API_KEY not configured. Add it to your environment or .env file.")
+        elif st.session_state.current_image is None:
+            st.error("Please upload an image first.")
+        else:
+            questions = list(presets.values())
+            img_bytes = st.session_state.current_image_bytes
+            submit_job(questions, generate_answers_parallel, questions, img_bytes)
+
+    # Answers still being generated off the script thread
+    if st.session_state._inflight:
+        poll_inflight()
 
     # TTS play for last answer (best-effort)
     if play_tts:
@@ -290,12 +689,19 @@ with col2:
             st.info("No answers available yet to play.")
         else:
             last_ans = st.session_state.history[-1]["answer"]
-            try:
-                engine = pyttsx3.init()
-                engine.say(last_ans)
-                engine.runAndWait()
-            except Exception as e:
-                st.warning(f"TTS playback failed: {e}")
+            tts_lock = get_tts_lock()
+            if not tts_lock.acquire(blocking=False):
+                st.toast("🔊 TTS already playing")
+            else:
+                try:
+                    threading.Thread(target=_speak, args=(last_ans, tts_lock, st.session_state._tts_status), daemon=True).start()
+                except Exception as e:
+                    tts_lock.release()
+                    st.warning(f"TTS playback failed: {e}")
+    # report a failure from a playback thread that finished since the last rerun
+    tts_error = st.session_state._tts_status.pop("error", None)
+    if tts_error:
+        st.warning(f"TTS playback failed: {tts_error}")
 
     # Per-message actions area (rating, pin, download)
     if st.session_state.history:
@@ -303,11 +709,11 @@ with col2:
         rr = st.slider("Rate the last answer (1-5)", min_value=1, max_value=5, value=3, key="rate_slider")
         if st.button("⭐ Save Rating"):
             last["rating"] = rr
-            save_history_to_disk()
+            _maybe_save(last)
             st.success("Thanks for rating!")
         if st.button("📌 Pin last"):
             last["pinned"] = not last.get("pinned", False)
-            save_history_to_disk()
+            _maybe_save(last)
             st.info("Pinned toggled.")
 
 # -----------------------
@@ -318,16 +724,3 @@ ach = st.session_state.achievements
 st.markdown(f"**🔥 Questions asked this session:** {ach['questions_today']}  •  **First upload done:** {'✅' if ach['first_upload_done'] else '❌'}")
 
 st.caption("No images are persisted. Text persistence is opt-in only. © Vision App")
-
-# small JS helper for clipboard copy (works on the page)
-st.markdown(
-    """
-    <script>
-    const copyBtns = document.querySelectorAll('[data-copy-target]')
-    function copyText(t) {
-      navigator.clipboard.writeText(t).then(()=>{console.log("copied")}, ()=>{console.log("failed")})
-    }
-    </script>
-    """,
-    unsafe_allow_html=True,
-)